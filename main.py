@@ -1,12 +1,33 @@
 import os
+import argparse
+import asyncio
+import atexit
 import json
-import re
 import hashlib
-from datetime import datetime
-
-from openai import OpenAI
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Literal
+from zoneinfo import ZoneInfo
+
+import blake3
+import httpx
+import msgpack
+import orjson
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
 from dotenv import load_dotenv
+from pydantic import BaseModel, Field, ValidationError
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+from tenacity.wait import wait_base
 import yfinance as yf
+from yfinance.exceptions import YFRateLimitError
 
 
 # ==============================
@@ -14,150 +35,685 @@ import yfinance as yf
 # ==============================
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# One pooled HTTP/2 connection reused across every OpenAI call
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+    timeout=30.0
+)
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client)
+
+# yfinance swallows network errors by default and returns an empty
+# frame; raise them instead so yfinance_retry can retry them
+yf.config.debug.hide_exceptions = False
+
+# Max concurrent yfinance requests (also the size of the worker thread pool)
+PRICE_CONCURRENCY = 10
+_price_semaphore = asyncio.Semaphore(PRICE_CONCURRENCY)
 
 OUTPUT_DIR = "outputs"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+HASH_LOG = "hash_log.txt"
+_hash_log = None
+
+CACHE_DIR = ".cache"
+# EOM closes don't change once the market has closed
+PRICE_CACHE_TTL = 24 * 60 * 60
+
+# Days of history to look back through for the last close
+PRICE_LOOKBACK_DAYS = 62
+
+# S&P 500 listings trade on NYSE / Nasdaq
+MARKET_TZ = ZoneInfo("America/New_York")
+MARKET_CLOSE_HOUR = 16
+
+# Retries for transient OpenAI / Yahoo failures
+RETRY_ATTEMPTS = 5
+RETRY_MAX_WAIT = 30
+
+# Batch API polling backoff (seconds)
+BATCH_POLL_INITIAL = 10
+BATCH_POLL_MAX = 600
+
 
 # ==============================
 # Helpers
 # ==============================
 
 def utc_now():
-    return datetime.utcnow().isoformat() + "Z"
+    return datetime.now(timezone.utc)
+
+
+def iso_utc(now):
+    return now.isoformat().replace("+00:00", "Z")
+
+
+class JsonObjectScanner:
+    """
+    Incremental brace-balance scan, usable on streamed replies.
+    feed() returns the objects nested one level inside the top-level
+    object (e.g. each entry of "recommendations") as soon as they close.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.current = []
+
+    def step(self, c):
+        """
+        Advances the depth / string / escape state by one character.
+        Braces inside string literals (and escaped quotes) are ignored.
+        """
+        if self.in_string:
+            if self.escaped:
+                self.escaped = False
+            elif c == "\\":
+                self.escaped = True
+            elif c == '"':
+                self.in_string = False
+        elif c == '"':
+            self.in_string = True
+        elif c == "{":
+            self.depth += 1
+        elif c == "}":
+            self.depth -= 1
+
+    def feed(self, chunk):
+        completed = []
+
+        for c in chunk:
+            before = self.depth
+            self.step(c)
+
+            if before < 2 <= self.depth:
+                self.current = [c]
+            elif before >= 2:
+                self.current.append(c)
+
+            if before == 2 and self.depth == 1:
+                try:
+                    completed.append(json.loads("".join(self.current)))
+                except json.JSONDecodeError:
+                    pass
+
+        return completed
+
+
+def _find_json_span(s: str) -> tuple[int, int] | None:
+    """
+    Single linear scan for the first balanced {...} object.
+    """
+    start = s.find("{")
+    if start == -1:
+        return None
+
+    scanner = JsonObjectScanner()
+
+    for i in range(start, len(s)):
+        scanner.step(s[i])
+        if scanner.depth == 0:
+            return start, i + 1
+
+    return None
 
 
 def safe_json_parse(text):
     """
     Attempts multiple ways to parse JSON safely.
-    Handles markdown code blocks and extra text.
+    Handles markdown code blocks and extra text (e.g. replies from
+    before JSON mode was enabled).
     """
     try:
         return json.loads(text)
-    except:
+    except json.JSONDecodeError:
         pass
 
     # Try extracting first {...} block
-    match = re.search(r"\{.*\}", text, re.DOTALL)
-    if match:
+    span = _find_json_span(text)
+    if span:
+        start, end = span
         try:
-            return json.loads(match.group())
-        except:
+            return json.loads(text[start:end])
+        except json.JSONDecodeError:
             pass
 
     return None
 
 
-def save_output(data, prefix="output"):
+def hash_log():
+    """
+    Lazily opened, line-buffered append handle kept for the whole process.
+    """
+    global _hash_log
+
+    if _hash_log is None:
+        _hash_log = open(HASH_LOG, "a", buffering=1)
+        atexit.register(_hash_log.close)
+
+    return _hash_log
+
+
+def save_output(data, prefix="output", now=None, json_view=False):
     """
     ALWAYS saves results + hash
+    The canonical artifact is MessagePack; json_view also writes a
+    human-readable .json next to it (not hashed).
+    Pass the same `now` used for the data's timestamp so the filename matches.
     """
-    filename = f"{OUTPUT_DIR}/{prefix}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.json"
+    now = now or utc_now()
+    base = os.path.join(OUTPUT_DIR, f"{prefix}_{now.strftime('%Y%m%d_%H%M%S')}")
+    filename = f"{base}.msgpack"
+
+    payload = msgpack.packb(data, use_bin_type=True)
+
+    with open(filename, "wb") as f:
+        f.write(payload)
 
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    if json_view:
+        with open(f"{base}.json", "wb") as f:
+            f.write(orjson.dumps(
+                data,
+                option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE
+            ))
 
-    hash_value = hashlib.sha256(json.dumps(data).encode()).hexdigest()
+    hash_value = blake3.blake3(payload).hexdigest()
 
-    with open("hash_log.txt", "a") as log:
-        log.write(f"{filename}: {hash_value}\n")
+    hash_log().write(f"{filename}: blake3:{hash_value}\n")
 
     print(f"✅ Saved → {filename}")
 
 
+# ==============================
+# Retries
+# ==============================
+
+class wait_retry_after(wait_base):
+    """
+    Waits for the server's retry-after header (e.g. on a 429), if any,
+    capped at RETRY_MAX_WAIT. Added to the jittered backoff below.
+    """
+
+    def __call__(self, retry_state):
+        response = getattr(retry_state.outcome.exception(), "response", None)
+        if response is None:
+            return 0
+
+        try:
+            retry_after = float(response.headers.get("retry-after", 0))
+        except ValueError:
+            return 0
+
+        # "not > 0" also rejects nan
+        if not retry_after > 0:
+            return 0
+        return min(retry_after, RETRY_MAX_WAIT)
+
+
+openai_retry = retry(
+    wait=wait_retry_after() + wait_exponential_jitter(1, RETRY_MAX_WAIT),
+    stop=stop_after_attempt(RETRY_ATTEMPTS),
+    retry=retry_if_exception_type(
+        (RateLimitError, APIConnectionError, InternalServerError, httpx.HTTPError)
+    ),
+    reraise=True
+)
+
+yfinance_retry = retry(
+    wait=wait_exponential_jitter(1, RETRY_MAX_WAIT),
+    stop=stop_after_attempt(RETRY_ATTEMPTS),
+    # OSError covers the curl_cffi network errors; yfinance only lets
+    # them through with hide_exceptions off (see Setup)
+    retry=retry_if_exception_type((YFRateLimitError, OSError)),
+    reraise=True
+)
+
+
+# ==============================
+# Caching
+# ==============================
+
+class FileCache:
+    """
+    Tiny JSON-file cache with a TTL, so repeated runs within a day
+    don't hit Yahoo again. Expired files are deleted: on read, and in a
+    sweep at startup (keys include the date, so most are never re-read).
+    """
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+        self.prune()
+
+    def _path(self, *key_parts):
+        key = hashlib.sha1("|".join(key_parts).encode()).hexdigest()
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _expired(self, path):
+        return time.time() - os.path.getmtime(path) > self.ttl
+
+    def prune(self):
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith(".json") and self._expired(entry.path):
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def get(self, *key_parts):
+        path = self._path(*key_parts)
+
+        try:
+            if self._expired(path):
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                return orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            return None
+
+    def set(self, value, *key_parts):
+        with open(self._path(*key_parts), "wb") as f:
+            f.write(orjson.dumps(value))
+
+
+price_cache = FileCache(CACHE_DIR, PRICE_CACHE_TTL)
+
+# In-process ticker cache, shared by the price worker threads
+_cache_lock = threading.Lock()
+_ticker_cache: dict[str, yf.Ticker] = {}
+
+
+def get_ticker(ticker):
+    with _cache_lock:
+        stock = _ticker_cache.get(ticker)
+        if stock is None:
+            stock = _ticker_cache[ticker] = yf.Ticker(ticker)
+    return stock
+
+
+@yfinance_retry
+def _fetch_history(ticker, start, end):
+    return get_ticker(ticker).history(start=start, end=end)
+
+
 # ==============================
 # Price functions
 # ==============================
 
-def get_end_of_month_price(ticker):
+def price_window(now):
+    """
+    (start, end) date strings for price lookups, computed once per run.
+    end is exclusive and taken in exchange time: before the close today's
+    unfinished session is left out, after it today's close is included.
+    """
+    local = now.astimezone(MARKET_TZ)
+    end = local.date()
+    if local.hour >= MARKET_CLOSE_HOUR:
+        end += timedelta(days=1)
+    start = end - timedelta(days=PRICE_LOOKBACK_DAYS)
+    return start.isoformat(), end.isoformat()
+
+
+@lru_cache(maxsize=4096)
+def _price_on(ticker, start, end):
     """
-    Gets most recent fully closed trading day (acts as EOM or latest accurate price)
+    Memoised per (ticker, window): a closed day's price never changes.
+    Raises LookupError when there's no data, so misses aren't cached.
     """
-    stock = yf.Ticker(ticker)
-    hist = stock.history(period="2mo")
+    cached = price_cache.get(ticker, start, end)
+    if cached is not None:
+        return cached
+
+    hist = _fetch_history(ticker, start, end)
 
     if hist.empty:
+        raise LookupError(f"No price history for {ticker}")
+
+    last_close = float(hist["Close"].iloc[-1])
+    price_cache.set(last_close, ticker, start, end)
+    return last_close
+
+
+def get_price_on(ticker, start, end):
+    """
+    Gets most recent fully closed trading day before `end`
+    (acts as EOM or latest accurate price)
+    """
+    try:
+        return _price_on(ticker, start, end)
+    except LookupError:
         return None
 
-    last_close = hist["Close"].iloc[-1]
-    return float(last_close)
+
+def download_prices(tickers, start, end):
+    """
+    Pulls every ticker in one pooled yf.download call.
+    Returns {ticker: last close} for the tickers that came back with data.
+    """
+    df = yf.download(
+        tickers,
+        start=start,
+        end=end,
+        group_by="ticker",
+        auto_adjust=True,
+        threads=True,
+        progress=False
+    )
+
+    prices = {}
+    if df.empty:
+        return prices
+
+    returned = set(df.columns.get_level_values(0))
+
+    for ticker in tickers:
+        if ticker not in returned:
+            continue
+
+        closes = df[ticker]["Close"].dropna()
+        if closes.empty:
+            continue
+
+        prices[ticker] = float(closes.iloc[-1])
+        price_cache.set(prices[ticker], ticker, start, end)
+
+    return prices
+
+
+async def fetch_price(ticker, start, end):
+    """
+    Single-ticker lookup in a worker thread (yfinance is sync),
+    bounded by PRICE_CONCURRENCY.
+    """
+    async with _price_semaphore:
+        return await asyncio.to_thread(get_price_on, ticker, start, end)
+
+
+async def get_end_of_month_prices(tickers, start, end):
+    """
+    Fetches prices for all tickers: cached prices first, then one
+    multi-ticker download, then concurrent single-ticker lookups for
+    anything still missing. Failed lookups come back as None.
+    """
+    prices = {t: price_cache.get(t, start, end) for t in tickers}
+
+    missing = [t for t, price in prices.items() if price is None]
+    if missing:
+        try:
+            prices.update(await asyncio.to_thread(download_prices, missing, start, end))
+        except Exception:
+            pass  # per-ticker fallback below
+
+    missing = [t for t, price in prices.items() if price is None]
+    if not missing:
+        return prices
+
+    results = await asyncio.gather(
+        *[fetch_price(t, start, end) for t in missing],
+        return_exceptions=True
+    )
+
+    for ticker, result in zip(missing, results):
+        prices[ticker] = None if isinstance(result, Exception) else result
+
+    return prices
 
 
 # ==============================
-# Main GPT query
+# OpenAI requests
 # ==============================
 
-def query_chatgpt_structured(model="gpt-4o-mini"):
+@openai_retry
+async def complete_streaming(body, on_object):
     """
-    Ask model for 10 S&P500 recommendations in STRICT JSON.
-    Always saves raw + parsed output.
+    Streams the completion and calls on_object for each nested JSON
+    object as soon as it closes, so callers can start work before the
+    reply is finished. Returns the full message content.
+    """
+    # tenacity owns retries here, so turn off the SDK's own
+    stream = await client.with_options(max_retries=0).chat.completions.create(
+        **body, stream=True
+    )
+
+    scanner = JsonObjectScanner()
+    parts = []
+
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+
+        parts.append(delta)
+        for obj in scanner.feed(delta):
+            on_object(obj)
+
+    return "".join(parts)
+
+
+class BatchError(RuntimeError):
+    """
+    Raised once a batch exists, so the error output can keep its id
+    (the batch is already paid for and its result may be recoverable).
+    """
+
+    def __init__(self, message, batch_id):
+        super().__init__(message)
+        self.batch_id = batch_id
+
+
+@openai_retry
+async def _retrieve_batch(batch_id):
+    return await client.with_options(max_retries=0).batches.retrieve(batch_id)
+
+
+@openai_retry
+async def _download_file(file_id):
+    return await client.with_options(max_retries=0).files.content(file_id)
+
+
+async def complete_batch(body, custom_id):
+    """
+    Runs a single chat completion through the Batch API (half the token
+    cost, up to 24h turnaround) and returns the message content.
     """
+    line = orjson.dumps({
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": body
+    }, option=orjson.OPT_APPEND_NEWLINE)
+
+    batch_file = await client.files.create(
+        file=(f"{custom_id}.jsonl", line),
+        purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+
+    try:
+        delay = BATCH_POLL_INITIAL
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX)
+            batch = await _retrieve_batch(batch.id)
+
+        # A request that failed inside the batch lands in the error file
+        file_id = batch.output_file_id or batch.error_file_id
+        if batch.status != "completed" or not file_id:
+            raise RuntimeError(f"finished with status {batch.status}")
+
+        output = await _download_file(file_id)
+    except Exception as e:
+        raise BatchError(f"Batch {batch.id}: {e}", batch.id) from e
+
+    result = orjson.loads(output.text.splitlines()[0])
+    response = result.get("response") or {}
+
+    if result.get("error") or response.get("status_code") != 200:
+        error = result.get("error") or response.get("body", {}).get("error")
+        raise BatchError(f"Batch {batch.id}: request failed: {error}", batch.id)
+
+    return response["body"]["choices"][0]["message"]["content"]
+
+
+# ==============================
+# Response schema
+# ==============================
+
+class Recommendation(BaseModel):
+    ticker: str
+    company: str
+    recommendation: Literal["Buy", "Hold", "Sell"]
+    confidence: float = Field(ge=0, le=1)
+    reasoning: str
+
+
+class RecommendationReply(BaseModel):
+    recommendations: list[Recommendation]
+
+
+# ==============================
+# Prompts
+# ==============================
 
-    prompt = """
-Return EXACTLY 10 S&P 500 stock recommendations.
+# Built once at import; nothing in it varies per call (no timestamps etc.)
+STRUCTURED_PROMPT = """Return EXACTLY 10 S&P 500 stock recommendations as JSON only, no markdown, in this format:
 
-Return ONLY valid JSON.
+{"recommendations": [{"ticker": "AAPL", "company": "Apple Inc", "recommendation": "Buy/Hold/Sell", "confidence": 0.0-1.0, "reasoning": "short explanation"}]}"""
 
-Format EXACTLY:
+STRUCTURED_MESSAGES = [{"role": "user", "content": STRUCTURED_PROMPT}]
 
-{
-  "timestamp": "<ISO8601>",
-  "recommendations": [
-    {
-      "ticker": "AAPL",
-      "company": "Apple Inc",
-      "recommendation": "Buy/Hold/Sell",
-      "confidence": 0.0-1.0,
-      "reasoning": "short explanation"
+
+# ==============================
+# Main GPT query
+# ==============================
+
+async def query_chatgpt_structured(model="gpt-4o-mini", use_batch=False, json_view=False):
+    """
+    Ask model for 10 S&P500 recommendations in STRICT JSON.
+    Always saves raw + parsed output.
+    use_batch submits through the Batch API instead of real-time.
+    json_view also writes a .json copy of each output.
+    """
+
+    body = {
+        "model": model,
+        "messages": STRUCTURED_MESSAGES,
+        "temperature": 0.3,
+        "response_format": {"type": "json_object"}
     }
-  ]
-}
 
-No text. No markdown. JSON only.
-"""
+    # Real-time replies are streamed: each recommendation's price lookup
+    # starts as soon as its object is complete
+    price_tasks = {}
+
+    def start_price_fetch(obj):
+        ticker = obj.get("ticker")
+        if isinstance(ticker, str) and ticker not in price_tasks:
+            price_tasks[ticker] = asyncio.create_task(fetch_price(ticker, start, end))
 
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
-        )
+        if use_batch:
+            raw = await complete_batch(body, custom_id="sp500_top10")
+            # A batch can take up to 24h; price as of when the reply arrived
+            start, end = price_window(utc_now())
+        else:
+            start, end = price_window(utc_now())
+            raw = await complete_streaming(body, on_object=start_price_fetch)
 
-        raw = response.choices[0].message.content.strip()
+        raw = raw.strip()
 
     except Exception as e:
-        save_output({"error": str(e)}, prefix="error")
+        for task in price_tasks.values():
+            task.cancel()
+        error = {"error": str(e)}
+        if isinstance(e, BatchError):
+            error["batch_id"] = e.batch_id
+        save_output(error, prefix="error", json_view=json_view)
         return
 
-    parsed = safe_json_parse(raw)
-
-    if parsed is None:
+    # Parses and validates in one pass; bad JSON is a ValidationError too
+    try:
+        reply = RecommendationReply.model_validate_json(raw)
+    except ValidationError as e:
+        for task in price_tasks.values():
+            task.cancel()
         # Save raw for debugging
+        now = utc_now()
         save_output({
-            "timestamp": utc_now(),
-            "error": "JSON parse failed",
+            "timestamp": iso_utc(now),
+            "error": "JSON parse/validation failed",
+            "details": e.errors(include_url=False, include_context=False),
             "raw_response": raw
-        }, prefix="bad_json")
+        }, prefix="bad_json", now=now, json_view=json_view)
         return
 
     # ==============================
     # Attach REAL prices
     # ==============================
 
-    for stock in parsed.get("recommendations", []):
-        ticker = stock["ticker"]
-        price = get_end_of_month_price(ticker)
-        stock["price"] = price
+    results = await asyncio.gather(*price_tasks.values(), return_exceptions=True)
+    prices = {
+        ticker: None if isinstance(result, Exception) else result
+        for ticker, result in zip(price_tasks, results)
+    }
+
+    recommendations = [r.model_dump() for r in reply.recommendations]
+    missing = [s["ticker"] for s in recommendations if s["ticker"] not in prices]
+    if missing:
+        prices.update(await get_end_of_month_prices(missing, start, end))
 
-    parsed["timestamp"] = utc_now()
+    for stock in recommendations:
+        stock["price"] = prices[stock["ticker"]]
 
-    save_output(parsed, prefix="stocks")
+    # Stamp when the reply and prices were captured, not when the request
+    # went out (a batch can take up to 24h)
+    now = utc_now()
+    save_output({
+        "timestamp": iso_utc(now),
+        "recommendations": recommendations
+    }, prefix="stocks", now=now, json_view=json_view)
 
 
 # ==============================
 # Run
 # ==============================
 
+async def main(use_batch=False, json_view=False):
+    # asyncio.to_thread runs on the default executor, which is sized from
+    # the CPU count; size it for the price fan-out instead
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=PRICE_CONCURRENCY)
+    )
+
+    try:
+        await query_chatgpt_structured(use_batch=use_batch, json_view=json_view)
+    finally:
+        await client.close()
+
+
 if __name__ == "__main__":
-    query_chatgpt_structured()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="use the OpenAI Batch API (50%% cheaper, up to 24h latency)"
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="also write a human-readable .json next to each .msgpack output"
+    )
+    args = parser.parse_args()
+
+    asyncio.run(main(use_batch=args.batch, json_view=args.json))